@@ -1,12 +1,36 @@
 import streamlit as st
 import chromadb
+from chromadb.config import Settings as ChromaSettings
 import requests
+import json
 import re
 import os
-from llama_index.core import VectorStoreIndex, Settings
-from llama_index.vector_stores.chroma import ChromaVectorStore
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import numpy as np
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from langdetect import detect
+from lingua import Language, LanguageDetectorBuilder
+
+# Detected language code -> language name used in the prompts
+_LANG_MAP = {"es": "SPANISH", "en": "ENGLISH", "fr": "FRENCH", "pt": "PORTUGUESE", "de": "GERMAN", "it": "ITALIAN"}
+
+# Reasoning chains emitted by reasoning models, stripped from every response
+# (including an unclosed chain left when the output is cut off by num_predict)
+_THINK_RE = re.compile(r'<think>.*?(?:</think>|\Z)', re.DOTALL)
+
+# Newlines flattened to spaces when assembling retrieved context
+_NL_TABLE = str.maketrans({"\n": " ", "\r": " "})
+
+# VERDICT / EXPLANATION / EVIDENCE sections of the verifier response (English or Spanish headers).
+# Each match is one section, running until the next header, so sections may come in any order.
+_SECTION_HEADERS = r'VERDICT|VEREDICTO|EXPLANATION|EXPLICACIÓN|EVIDENCE|EVIDENCIAS'
+_SECTION_RE = re.compile(
+    rf'^\s*(?P<header>{_SECTION_HEADERS})\s*:(?P<body>.*?)(?=^\s*(?:{_SECTION_HEADERS})\s*:|\Z)',
+    re.DOTALL | re.MULTILINE | re.IGNORECASE
+)
 
 # =============================================================================
 # 1. PAGE CONFIGURATION
@@ -42,63 +66,244 @@ class LLMClient:
             self.api_key = ""
             st.warning("⚠️ API Key not found. Please configure 'LLM_API_KEY'.")
 
-        self.options = {"temperature": 0.0, "num_ctx": 8192}
+        # num_predict caps the answer length; stop sequences cut runaway continuations
+        self.options = {
+            "temperature": 0.0,
+            "num_ctx": 8192,
+            "num_predict": 512,
+            "stop": ["\n### ", "YOUR RESPONSE:"]
+        }
+
+        # Pooled HTTP session: reuses TCP/TLS connections across calls
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # TLS: verify against a pinned CA bundle (e.g. the server's self-signed cert) once per session.
+        # LLM_INSECURE=1/true/yes disables verification for local development only.
+        if os.getenv("LLM_INSECURE", "").strip().lower() in ("1", "true", "yes"):
+            self.session.verify = False
+            requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+        else:
+            self.session.verify = os.getenv("LLM_CA_BUNDLE", True)
+
+    # Fixed context sizes: Ollama reloads the model runner whenever num_ctx changes, so a
+    # per-prompt value would reload on almost every call. Two buckets trade some KV-cache
+    # memory for at most one reload when a prompt crosses the boundary; the verification and
+    # summary prompts carry the same context, so they normally land in the same bucket.
+    _CTX_SIZES = (4096, 8192)
 
-    def generate(self, prompt):
+    # Minimum seconds between on_token updates while streaming (one UI update per token is too many)
+    _STREAM_UPDATE_INTERVAL = 0.1
+
+    def _pick_ctx(self, prompt, reserve=512):
+        """
+        Smallest fixed context window fitting the prompt plus room for the answer.
+        Uses a ~3 characters per token heuristic instead of a tokenizer.
+        """
+        approx_tokens = len(prompt) // 3 + reserve
+        return next((size for size in self._CTX_SIZES if approx_tokens <= size), self._CTX_SIZES[-1])
+
+    def request(self, prompt, on_token=None, max_tokens=None):
+        """
+        Streams the prompt's answer from the LLM and returns the cleaned text. Raises on failure.
+        on_token (optional) is called with the running text as chunks arrive (throttled).
+        max_tokens (optional) overrides the default num_predict cap.
+        """
+        num_predict = max_tokens or self.options["num_predict"]
         headers = {"X-API-KEY": self.api_key, "Content-Type": "application/json"}
         payload = {
             "model": self.model,
             "prompt": prompt,
-            "stream": False,
-            "options": self.options
+            "stream": True,
+            # Thinking tokens count toward num_predict, so reasoning is turned off
+            "think": False,
+            "options": {
+                **self.options,
+                "num_ctx": self._pick_ctx(prompt, reserve=num_predict),
+                "num_predict": num_predict
+            }
         }
-        try:
-            # Note: verify=False is used here for self-signed certs; remove for production if possible
-            response = requests.post(self.api_url, json=payload, headers=headers, verify=False)
+        # verify is passed explicitly: REQUESTS_CA_BUNDLE / CURL_CA_BUNDLE would otherwise override the session setting
+        with self.session.post(self.api_url, json=payload, headers=headers, stream=True, verify=self.session.verify) as response:
             response.raise_for_status()
-            response_text = response.json().get("response", "")
-            
-            # --- CLEAN <think> TAGS ---
-            # Removes reasoning chains often output by reasoning models
-            clean_text = re.sub(r'<think>.*?</think>', '', response_text, flags=re.DOTALL).strip()
-            
-            return clean_text
             
+            # NDJSON stream: one JSON object per line with a partial "response".
+            # Errors after the 200 header arrive as an {"error": ...} line.
+            response_text = ""
+            done = False
+            last_update = 0.0
+            for line in response.iter_lines():
+                if not line: continue
+                data = json.loads(line)
+                if "error" in data:
+                    raise RuntimeError(data["error"])
+                response_text += data.get("response", "")
+                if on_token and time.monotonic() - last_update >= self._STREAM_UPDATE_INTERVAL:
+                    on_token(response_text)
+                    last_update = time.monotonic()
+                if data.get("done"):
+                    done = True
+                    break
+            if not done:
+                raise RuntimeError("LLM stream ended before completion")
+        
+        # --- CLEAN <think> TAGS ---
+        # Removes reasoning chains often output by reasoning models
+        clean_text = _THINK_RE.sub('', response_text).strip()
+        
+        return clean_text
+
+    def generate(self, prompt, max_tokens=None):
+        try:
+            return self.request(prompt, max_tokens=max_tokens)
         except Exception as e:
             return f"Error: {e}"
 
-# Initialize Client
+# Initialize Client (cached so the connection pool survives Streamlit reruns)
 # Note: You can pass api_url here if needed, or set it via env vars
-llm_client = LLMClient()
+@st.cache_resource
+def get_llm_client():
+    return LLMClient()
+
+llm_client = get_llm_client()
+
+# Response cache shared across sessions: (prompt hash, model, max_tokens) -> (timestamp, text).
+# A plain dict instead of st.cache_data: the streaming callback writes to a placeholder,
+# and st.cache_data would try to replay that element call on every cache hit.
+# Insertion order doubles as age order, so the oldest entry is evicted first when full.
+_RESPONSE_TTL = 24*60*60
+_RESPONSE_CACHE_MAX = 512
+
+@st.cache_resource
+def get_response_cache():
+    return {}, threading.Lock()
+
+response_cache, response_cache_lock = get_response_cache()
+
+def cached_generate(prompt, model, on_token=None, max_tokens=None):
+    """
+    Same as LLMClient.generate, but identical prompts are answered from the cache.
+    On a miss the answer is streamed through on_token and stored; errors are never cached.
+    """
+    key = (hashlib.sha256(prompt.encode()).hexdigest(), model, max_tokens)
+    with response_cache_lock:
+        hit = response_cache.get(key)
+    if hit and time.time() - hit[0] < _RESPONSE_TTL:
+        return hit[1]
+
+    try:
+        text = llm_client.request(prompt, on_token=on_token, max_tokens=max_tokens)
+    except Exception as e:
+        return f"Error: {e}"
+
+    # Drop expired entries, then the oldest ones, so the cache stays bounded
+    now = time.time()
+    with response_cache_lock:
+        for old_key in [k for k, (ts, _) in response_cache.items() if now - ts >= _RESPONSE_TTL]:
+            del response_cache[old_key]
+        response_cache.pop(key, None)
+        while len(response_cache) >= _RESPONSE_CACHE_MAX:
+            del response_cache[next(iter(response_cache))]
+        response_cache[key] = (now, text)
+    return text
 
 # =============================================================================
 # 3. DATABASE LOADING
 # =============================================================================
 @st.cache_resource
-def load_index():
+def get_embed_model():
+    # Single embedding model instance shared across sessions and reruns
+    embed_model = HuggingFaceEmbedding(model_name="intfloat/multilingual-e5-small")
+
+    # INT8 dynamic quantization of the Linear layers (CPU only) for faster query encoding
+    if next(embed_model._model.parameters()).device.type == "cpu":
+        torch.quantization.quantize_dynamic(
+            embed_model._model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    return embed_model
+
+@st.cache_resource
+def get_chroma():
+    # Single persistent client; telemetry off avoids a background thread and network call
+    return chromadb.PersistentClient(path="./chroma_db", settings=ChromaSettings(anonymized_telemetry=False))
+
+@st.cache_resource
+def load_collection():
     try:
         # print("🔌 Connecting to ChromaDB...")
-        Settings.embed_model = HuggingFaceEmbedding(
-            model_name="intfloat/multilingual-e5-small"
-        )
+        # Load the embedding model at startup rather than on the first claim
+        get_embed_model()
         # Ensure the path './chroma_db' exists or is correctly pointed to
-        db = chromadb.PersistentClient(path="./chroma_db")
+        db = get_chroma()
         chroma_collection = db.get_or_create_collection("rag")
-        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-        index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
-        return index
+        return chroma_collection
     except Exception as e:
         st.error(f"Error loading database: {e}")
         return None
 
-index = load_index()
+collection = load_collection()
+
+def embed_queries(texts):
+    """
+    Encodes several queries in a single batched forward pass. Goes through the wrapper's own
+    _embed() with the "query" prompt, so the query instruction, max length and normalization
+    match the ones used to embed the index.
+    """
+    vectors = get_embed_model()._embed(list(texts), prompt_name="query")
+    return np.ascontiguousarray(vectors, dtype=np.float32)
+
+# Metadata fields used to cite a retrieved chunk
+_CITATION_KEYS = ("titulo", "title", "url")
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def cached_retrieve(claim, k):
+    """
+    Retrieves the top-k chunks for a claim. Returns plain dicts so st.cache_data can store them.
+    Queries the Chroma collection directly (only documents and metadata) instead of the LlamaIndex retriever.
+    """
+    results = load_collection().query(
+        # Plain lists: older chromadb releases reject numpy arrays here
+        query_embeddings=embed_queries([claim]).tolist(),
+        n_results=k,
+        include=["documents", "metadatas"],
+    )
+    # Keep only the metadata used for citations (LlamaIndex's _node_content would duplicate the text)
+    return [
+        {"content": doc, "metadata": {key: meta[key] for key in _CITATION_KEYS if key in (meta or {})}}
+        for doc, meta in zip(results["documents"][0], results["metadatas"][0])
+    ]
+
+def dedupe_chunks(chunks, threshold=0.8):
+    """
+    Drops chunks whose 5-gram shingle Jaccard similarity with an earlier chunk exceeds the threshold.
+    """
+    kept, kept_shingles = [], []
+    for chunk in chunks:
+        content = chunk["content"]
+        shingles = {content[i:i+5] for i in range(len(content) - 4)}
+        if any(len(shingles & prev) / len(shingles | prev) > threshold for prev in kept_shingles if shingles | prev):
+            continue
+        kept.append(chunk)
+        kept_shingles.append(shingles)
+    return kept
+
+@st.cache_resource
+def get_language_detector():
+    # lingua (compiled, models bundled with the package); restricted to the supported languages
+    return LanguageDetectorBuilder.from_languages(*(getattr(Language, name) for name in _LANG_MAP.values())).build()
+
+@st.cache_data(show_spinner=False)
+def detect_lang(text):
+    language = get_language_detector().detect_language_of(text)
+    return language.iso_code_639_1.name.lower() if language else "en"
 
 # =============================================================================
 # 4. VERIFICATION LOGIC (WITH HALLUCINATION GUARDRAILS)
 # =============================================================================
-def query_verifier(context, claim, target_language):
-    # --- OPTIMIZED PROMPT ---
-    prompt = f"""
+# --- OPTIMIZED PROMPT ---
+_VERIFY_TMPL = """
 You are an expert Polyglot Fact-Checker.
 Your goal is to verify the CLAIM using the provided CONTEXT.
 
@@ -124,45 +329,41 @@ EVIDENCE:
 
 ### YOUR RESPONSE:
 """
-    raw_response = llm_client.generate(prompt)
+
+def query_verifier(context, claim, target_language, on_token=None):
+    prompt = _VERIFY_TMPL.format_map({"context": context, "claim": claim, "target_language": target_language})
+    raw_response = cached_generate(prompt, llm_client.model, on_token, max_tokens=512)
     
+    return parse_verifier_response(raw_response)
+
+def parse_verifier_response(raw_response):
+    """
+    Parses the VERDICT / EXPLANATION / EVIDENCE sections of the verifier output.
+    """
     # --- RESPONSE PARSING ---
     # 1. Default structure in case LLM fails
     result = {"verdict": "NO INFO", "explanation": "", "evidence": []}
     
-    # 2. Parse line by line
-    lines = raw_response.split('\n')
-    mode = None
-    for line in lines:
-        line = line.strip()
-        if not line: continue
+    # 2. Parse section by section (any order; a repeated VERDICT/EXPLANATION keeps the last one)
+    for match in _SECTION_RE.finditer(raw_response):
+        header = match["header"].upper()
+        body = match["body"]
         
-        # --- A) DETECT VERDICT ---
-        if line.upper().startswith("VERDICT:") or line.upper().startswith("VEREDICTO:"):
-            val = line.split(":")[1].strip().upper()
-
+        # --- A) VERDICT ---
+        if header in ("VERDICT", "VEREDICTO"):
+            val = body.split("\n", 1)[0].strip().upper()
             if "TRUE" in val or "VERDADERO" in val: result["verdict"] = "TRUE"
             elif "FALSE" in val or "FALSO" in val: result["verdict"] = "FALSE"
             else: result["verdict"] = "NO INFO"
-            
-        # --- B) DETECT EXPLANATION ---
-        elif line.upper().startswith("EXPLANATION:") or line.upper().startswith("EXPLICACIÓN:"):
-            result["explanation"] = line.split(":", 1)[1].strip()
-            mode = "explanation"
-
-        # --- C) DETECT EVIDENCE ---    
-        elif line.upper().startswith("EVIDENCE:") or line.upper().startswith("EVIDENCIAS:"):
-            mode = "evidence"
         
-        # --- D) PROCESS EVIDENCE LINES ---
-        elif mode == "evidence" and "||" in line:
-            parts = line.split("||")
-            if len(parts) >= 2:
-                result["evidence"].append({"quote": parts[0].strip(), "source": parts[1].strip()})
+        # --- B) MULTI-LINE EXPLANATION ---
+        elif header in ("EXPLANATION", "EXPLICACIÓN"):
+            result["explanation"] = " ".join(body.split())
         
-        # --- E) PROCESS MULTI-LINE EXPLANATION ---
-        elif mode == "explanation" and not line.upper().startswith("EVIDENCE"):
-            result["explanation"] += " " + line
+        # --- C) EVIDENCE LINES ("quote" || source) ---
+        else:
+            parts = [line.split("||") for line in body.splitlines() if "||" in line]
+            result["evidence"] += [{"quote": p[0].strip(), "source": p[1].strip()} for p in parts]
 
     # --- GUARDRAIL: LOGICAL FILTER ---
     # If verdict is NO INFO, clear any potential hallucinations in evidence
@@ -175,11 +376,7 @@ EVIDENCE:
 # AUXILIARY FUNCTION: CONTEXT SUMMARY
 # =============================================================================
 
-def generate_context_summary(context, claim, target_language):
-    """
-    Generates a narrative summary of available information regarding the claim.
-    """
-    prompt = f"""
+_SUMMARY_TMPL = """
     You are a helpful assistant.
     
     INPUTS:
@@ -197,8 +394,19 @@ def generate_context_summary(context, claim, target_language):
     
     SUMMARY:
     """
+
+def generate_context_summary(context, claim, target_language, on_token=None):
+    """
+    Generates a narrative summary of available information regarding the claim.
+    """
+    prompt = _SUMMARY_TMPL.format_map({"context": context, "claim": claim, "target_language": target_language})
     
-    return llm_client.generate(prompt)
+    return cached_generate(prompt, llm_client.model, on_token, max_tokens=300)
+
+# Background worker for speculative summaries (shared across sessions, survives reruns)
+@st.cache_resource
+def get_summary_executor():
+    return ThreadPoolExecutor(max_workers=2)
 
 # =============================================================================
 # 5. USER INTERFACE (STATE MANAGEMENT & BUTTONS)
@@ -213,6 +421,8 @@ if 'current_language' not in st.session_state:
     st.session_state.current_language = "ENGLISH"
 if 'generated_summary' not in st.session_state:
     st.session_state.generated_summary = None
+if 'summary_future' not in st.session_state:
+    st.session_state.summary_future = None
 
 # User Input
 claim_input = st.text_input("Enter a claim to verify (Any language):", 
@@ -220,7 +430,7 @@ claim_input = st.text_input("Enter a claim to verify (Any language):",
 
 # Main Button: Verify
 if st.button("Verify Claim", type="primary"):
-    if not index:
+    if collection is None:
         st.error("Database is not loaded.")
     elif not claim_input:
         st.warning("Please enter a claim.")
@@ -229,20 +439,14 @@ if st.button("Verify Claim", type="primary"):
             # Clear previous results
             st.session_state.verification_data = None
             st.session_state.generated_summary = None
+            st.session_state.summary_future = None
 
             # 1. Language Detection
-            try:
-                lang_code = detect(claim_input)
-            except:
-                lang_code = "en"
-            
-            lang_map = {"es": "SPANISH", "en": "ENGLISH", "fr": "FRENCH", "pt": "PORTUGUESE", "de": "GERMAN", "it": "ITALIAN"}
-            target_language = lang_map.get(lang_code, "ENGLISH")
+            target_language = _LANG_MAP.get(detect_lang(claim_input), "ENGLISH")
             st.session_state.current_language = target_language
 
             # 2. Retrieval
-            retriever = index.as_retriever(similarity_top_k=3)
-            nodes = retriever.retrieve(claim_input)
+            nodes = dedupe_chunks(cached_retrieve(claim_input.strip(), 3))
             
             if not nodes:
                 st.warning("⚠️ No relevant information found in the database.")
@@ -250,18 +454,29 @@ if st.button("Verify Claim", type="primary"):
                 # Prepare Context
                 context_parts = []
                 for n in nodes:
-                    meta = n.metadata
+                    meta = n["metadata"]
                     title = meta.get('titulo') or meta.get('title') or "Doc"
                     url = meta.get('url') or "Local"
-                    content = n.get_content().replace('\n', ' ')
+                    content = n["content"]
+                    if "\n" in content:
+                        content = content.translate(_NL_TABLE)
                     context_parts.append(f"[SOURCE: {title} ({url})]\n{content}")
                 
                 context_str = "\n\n".join(context_parts)
                 st.session_state.current_context = context_str
                 
-                # 3. Verification
-                data = query_verifier(context_str, claim_input, target_language)
-                st.session_state.verification_data = data
+                # 3. Verification (streamed into a placeholder in this thread)
+                stream_placeholder = st.empty()
+                st.session_state.verification_data = query_verifier(
+                    context_str, claim_input, target_language, on_token=stream_placeholder.markdown
+                )
+                stream_placeholder.empty()
+
+                # 4. Speculative summary: runs in the background while the verdict is read,
+                #    and is only waited on if the summary button is clicked
+                st.session_state.summary_future = get_summary_executor().submit(
+                    generate_context_summary, context_str, claim_input, target_language
+                )
 
 # --- RESULT VISUALIZATION ---
 
@@ -302,13 +517,26 @@ if st.session_state.verification_data:
     
     with col_btn:
         if st.button("📝 Generate Context Summary"):
-            with st.spinner("Generating summary..."):
-                summary = generate_context_summary(
-                    st.session_state.current_context, 
-                    claim_input, 
-                    st.session_state.current_language
-                )
+            summary = None
+            if st.session_state.summary_future:
+                with st.spinner("Generating summary..."):
+                    summary = st.session_state.summary_future.result()
+                st.session_state.summary_future = None
+
+            # A failed prefetch is not a summary: fall through to a live call
+            if summary and not summary.startswith("Error:"):
                 st.session_state.generated_summary = summary
+            else:
+                with st.spinner("Generating summary..."):
+                    stream_placeholder = st.empty()
+                    summary = generate_context_summary(
+                        st.session_state.current_context, 
+                        claim_input, 
+                        st.session_state.current_language,
+                        on_token=stream_placeholder.markdown
+                    )
+                    stream_placeholder.empty()
+                    st.session_state.generated_summary = summary
 
     # Show summary if generated
     if st.session_state.generated_summary: